@@ -2,18 +2,169 @@
 (written by Jeff Jennings)."""
 
 import os
-import json
+# limit OpenMP/BLAS threading in this process and in the worker processes 
+# sources are distributed over, so N workers do not each start a thread per 
+# core (must be set before numpy is imported; values already set in the 
+# environment are kept)
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+os.environ.setdefault('MKL_NUM_THREADS', '1')
+os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
 import numpy as np 
 import matplotlib.pyplot as plt 
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.lines import Line2D
+import multiprocess
 
 from arksia.pipeline import model_setup
-from arksia.input_output import load_bestfit_profiles
+from arksia.input_output import load_bestfit_profiles, get_bestfit_paths, is_up_to_date, load_json, \
+    save_json
+
+def process_disk(jj, gen_pars, disk_pars, gen_par_f, source_par_f, phys_par_f,
+                 profiles_txt=True, robust=0.5, include_rave=False):
+    """
+    Obtain the clean, frank and optionally rave radial brightness profiles
+    for a single source, sampled at the frank radial points.
+
+    Parameters
+    ----------
+    jj : string
+        Source name
+    gen_pars : dict
+        Generic parameters (contents of `gen_par_f`)
+    disk_pars : dict
+        Source-specific parameters for `jj` (entry of `source_par_f`)
+    gen_par_f, source_par_f, phys_par_f, profiles_txt, robust, include_rave :
+        See `main`
+
+    Returns
+    -------
+    rf : array
+        Frank radial points [arcsec]
+    Is_interp : list of array
+        Clean, (rave,) frank brightness profiles sampled at `rf` [Jy / sterad]
+    Ies_interp : list of list of array
+        Lower and upper 1 sigma uncertainties on each profile in `Is_interp`
+    fstar : float
+        Stellar flux subtracted in the frank fit [Jy]
+    dist : float
+        Source distance [pc]
+    save_dir : string
+        Directory in which results for the source are saved
+    """
+    # update generic parameters that vary by source
+    gen_pars['base']['input_dir'] = f"./{jj}"
+    gen_pars['clean']['robust'] = disk_pars["clean"]["bestfit"]["robust"]
+
+    # save updated gen_pars (to a unique file per source, as sources can be
+    # processed in parallel)
+    gen_pars_current = os.path.join(os.path.dirname(gen_par_f), f'pars_gen_temp_{jj}.json')
+    save_json(gen_pars, gen_pars_current)
+
+    # generate model for source
+    class parsed_args():
+        base_parameter_filename = gen_pars_current
+        source_parameter_filename = source_par_f
+        physical_parameter_filename = phys_par_f
+        disk = jj
+    model = model_setup(parsed_args)
+
+    os.remove(gen_pars_current)
+
+    if profiles_txt == 'npz':
+        ff = '{}/{}_radial_profiles.npz'.format(model["base"]["save_dir"], jj)
+    else:
+        ff = '{}/{}_radial_profiles.txt'.format(model["base"]["save_dir"], jj)
+
+    # reuse the saved profiles for this source if they are newer than
+    # the best-fit clean, rave, frank results they were made from, and than
+    # the parameter files that set e.g. the source distance used in them
+    clean_path, rave_path, frank_path = get_bestfit_paths(model)
+    fit_paths = [clean_path, frank_path, gen_par_f, source_par_f, phys_par_f]
+    col_names = ['r', 'I_clean', 'sigma_clean', 'I_frank', 'sigma_frank']
+    if include_rave:
+        fit_paths.append(rave_path)
+        col_names += ['I_rave', 'sigma_lower_rave', 'sigma_upper_rave']
+
+    saved_profiles = None
+    if is_up_to_date([ff], fit_paths):
+        # columns in saved file must match those expected given 'include_rave'
+        if profiles_txt == 'npz':
+            with np.load(ff) as dat:
+                if set(col_names + ['header']) == set(dat.files):
+                    saved_profiles = np.column_stack([dat[cc] for cc in col_names])
+        else:
+            # (2D even if the file has a single row)
+            saved_profiles = np.atleast_2d(np.genfromtxt(ff))
+            if saved_profiles.shape[1] != len(col_names):
+                saved_profiles = None
+
+    if saved_profiles is not None:
+        print('  Survey summary: loading up-to-date radial profiles from {}'.format(ff))
+        rf = saved_profiles[:, 0] / model["base"]["dist"]
+        Ic_interp, Iec_interp, If, Ief = saved_profiles[:, 1:5].T
+        if include_rave:
+            Ir_interp, Ier_lo_interp, Ier_hi_interp = saved_profiles[:, 5:].T
+
+    else:
+        # best-fit clean, rave, frank profile for source
+        fits = load_bestfit_profiles(model, robust, include_rave=include_rave)
+        [[rc, Ic, Iec], [grid, Vc]] = fits[0]
+        [[rf, If, Ief], [grid, Vf], sol] = fits[2]
+        if include_rave:
+            [[rr, Ir, Ier_lo, Ier_hi], [grid, Vr]] = fits[1]
+
+        # interpolate clean and rave profiles onto frank radial points
+        Ic_interp = np.interp(rf, rc, Ic)
+        Iec_interp = np.interp(rf, rc, Iec)
+        if include_rave:
+            Ir_interp = np.interp(rf, rr, Ir)
+            Ier_lo_interp = np.interp(rf, rr, Ier_lo)
+            Ier_hi_interp = np.interp(rf, rr, Ier_hi)
+
+    if include_rave:
+        Is_interp = [Ic_interp, Ir_interp, If]
+        Ies_interp = [[Iec_interp, Iec_interp], [Ier_lo_interp, Ier_hi_interp], [Ief, Ief]]
+    else:
+        Is_interp = [Ic_interp, If]
+        Ies_interp = [[Iec_interp, Iec_interp], [Ief, Ief]]
+
+
+    if profiles_txt and saved_profiles is None:
+        print('  Survey summary: saving radial profiles to {}'.format(ff))
+
+        # save .txt file per source with clean,rave,frank profiles
+        header=f"dist={model['base']['dist']} [au].\nAll brightnesses in [Jy/steradian].\nUncertainties not comparable across models. "
+
+        # one column per profile, in the order of 'col_names'
+        profiles = np.empty((rf.size, len(col_names)))
+        profiles[:, 0] = rf * model["base"]["dist"]
+        profiles[:, 1] = Ic_interp
+        profiles[:, 2] = Iec_interp
+        profiles[:, 3] = If
+        profiles[:, 4] = Ief
+
+        if include_rave:
+            profiles[:, 5] = Ir_interp
+            profiles[:, 6] = Ier_lo_interp
+            profiles[:, 7] = Ier_hi_interp
+            header += "Rave uncertainties have unique lower and upper bounds.\nColumns: "
+            header += "r [au]\t\tI_clean\t\tsigma_clean\t\tI_frank\t\tsigma_frank\t\tI_rave\t\tsigma_lower_rave\t\tsigma_upper_rave"
+        else:
+            header += "\nColumns: r [au]\t\tI_clean\t\tsigma_clean\t\tI_frank\t\tsigma_frank"
+
+        if profiles_txt == 'npz':
+            np.savez_compressed(ff, header=header, **dict(zip(col_names, profiles.T)))
+        else:
+            np.savetxt(ff, profiles, header=header)
+
+    return rf, Is_interp, Ies_interp, model["frank"]["fstar"], model["base"]["dist"], model["base"]["save_dir"]
+
 
 def main(gen_par_f='./pars_gen.json',
          source_par_f='./pars_source.json', 
          phys_par_f='./summary_disc_parameters.csv',
          profiles_txt=True, profiles_fig=True, robust=0.5,
-         include_rave=False
+         include_rave=False, nprocs=None
          ):
     """
     Generate summary radial profile results across multiple survey sources.
@@ -26,9 +177,11 @@ def main(gen_par_f='./pars_gen.json',
         Path to the parameter file with custom values for each source         
     phys_par_f : string, default='pars_gen.json'
         Path to the physical parameters file
-    profiles_txt : bool, default=True
+    profiles_txt : bool or 'npz', default=True
         Whether to produce a .txt file per source containting the 
-        clean, rave, frank brightness profiles (sampled at same radii)
+        clean, rave, frank brightness profiles (sampled at same radii). 
+        If 'npz', the profiles are instead saved to a (binary) .npz file 
+        per source, with one entry per column of the .txt file
     profiles_fig : bool, default=True
         Whether to produce a single figure showing brightness profiles for 
         all sources
@@ -36,139 +189,131 @@ def main(gen_par_f='./pars_gen.json',
         Robust weighting value to use for retrieving clean, rave results
     include_rave : bool, default=True
         Whether to include rave results in summary
+    nprocs : int, default=None
+        Number of processes over which to distribute the sources. If None,
+        one process per source is used, up to the number of available CPUs
 
     Returns
     -------
-    figs : `plt.figure` instance
-        The generated figures, produced if `profiles_fig` is True
+    figs : list of `plt.figure` instance
+        The generated figures (closed after saving), produced if 
+        `profiles_fig` is True (otherwise an empty list)
     """
 
     # get all source names
-    source_pars = json.load(open(source_par_f, 'r'))
-    disk_names = []
-    for dd in source_pars:
-        disk_names.append(dd)
-
-    fig0, axs0 = plt.subplots(nrows=5, ncols=4, figsize=(10, 10), squeeze=True)
-    fig1, axs1 = plt.subplots(nrows=5, ncols=4, figsize=(10, 10), squeeze=True)
-    figs, axs = [fig0, fig1], [axs0, axs1]
-
-    gen_pars = json.load(open(gen_par_f, 'r'))
-    source_pars = json.load(open(source_par_f, 'r'))
-
-    for ii, jj in enumerate(disk_names):
-        # update generic parameters that vary by source
-        gen_pars['base']['input_dir'] = f"./{jj}"
-        disk_pars = source_pars[jj]
-        gen_pars['clean']['robust'] = disk_pars["clean"]["bestfit"]["robust"]
-
-        # save updated gen_pars
-        gen_pars_current = os.path.join(os.path.dirname(gen_par_f), 'pars_gen_temp.json')
-        with open(gen_pars_current, 'w') as f:
-            json.dump(gen_pars, f)
-
-        # generate model for each source
-        class parsed_args():
-            base_parameter_filename = gen_pars_current
-            source_parameter_filename = source_par_f
-            physical_parameter_filename = phys_par_f
-            disk = jj
-        model = model_setup(parsed_args)
-
-        # best-fit clean, rave, frank profile for each source
-        fits = load_bestfit_profiles(model, robust, include_rave=include_rave)
-        [[rc, Ic, Iec], [grid, Vc]] = fits[0]
-        [[rf, If, Ief], [grid, Vf], sol] = fits[2]
-        if include_rave:
-            [[rr, Ir, Ier_lo, Ier_hi], [grid, Vr]] = fits[1]        
+    source_pars = load_json(source_par_f)
+    disk_names = list(source_pars)
 
-        # interpolate clean and rave profiles onto frank radial points 
-        Ic_interp = np.interp(rf, rc, Ic)
-        Iec_interp = np.interp(rf, rc, Iec)
-        if include_rave:
-            Ir_interp = np.interp(rf, rr, Ir)
-            Ier_lo_interp = np.interp(rf, rr, Ier_lo)
-            Ier_hi_interp = np.interp(rf, rr, Ier_hi)
+    gen_pars = load_json(gen_par_f)
+
+    # load, interpolate (and save) the profiles of each source
+    def disk_profiles(jj):
+        return process_disk(jj, gen_pars, source_pars[jj], gen_par_f, source_par_f, phys_par_f,
+                            profiles_txt=profiles_txt, robust=robust, include_rave=include_rave)
+
+    if nprocs is None:
+        nprocs = min(len(disk_names), multiprocess.cpu_count())
+
+    if nprocs > 1:
+        print(f"  Survey summary: processing {len(disk_names)} sources using {nprocs} processes")
+        with multiprocess.Pool(processes=nprocs) as pool:
+            results = pool.map(disk_profiles, disk_names)
+    else:
+        results = [disk_profiles(jj) for jj in disk_names]
+
+    if not profiles_fig:
+        return []
+
+    print('  Survey summary: making survey summary figure')
+
+    # rendering settings for the survey figures (not changed globally)
+    survey_rc = {'text.usetex': False, 'agg.path.chunksize': 10000}
+
+    with plt.rc_context(survey_rc):
+        # generate, save figures for brightness profiles of all sources and brightness profiles with uncertainties
+        fig0, axs0 = plt.subplots(nrows=5, ncols=4, figsize=(10, 10), squeeze=True)
+        fig1, axs1 = plt.subplots(nrows=5, ncols=4, figsize=(10, 10), squeeze=True)
+        figs = [fig0, fig1]
+        # flatten axes
+        axs_flat = [np.asarray(axs0).ravel(), np.asarray(axs1).ravel()]
 
-            Is_interp = [Ic_interp, Ir_interp, If]
-            Ies_interp = [[Iec_interp, Iec_interp], [Ier_lo_interp, Ier_hi_interp], [Ief, Ief]]
+        # profile order in results is clean, (rave,) frank
+        if include_rave:
+            cols, labs = ['C1', 'C3', 'C2'], ['clean', 'rave', 'frank']
         else:
-            Is_interp = [Ic_interp, If]
-            Ies_interp = [[Iec_interp, Iec_interp], [Ief, Ief]]
-
-
-        if profiles_txt:
-            ff = '{}/{}_radial_profiles.txt'.format(model["base"]["save_dir"], jj)
-            print('  Survey summary: saving radial profiles to {}'.format(ff))
-
-            # save .txt file per source with clean,rave,frank profiles
-            header=f"dist={model['base']['dist']} [au].\nAll brightnesses in [Jy/steradian].\nUncertainties not comparable across models. "
-
-            if include_rave:
-                profiles = np.array([rf * model["base"]["dist"], Ic_interp, Iec_interp, 
-                              If, Ief, Ir_interp, Ier_lo_interp, Ier_hi_interp
-                              ])
-                header += "Rave uncertainties have unique lower and upper bounds.\nColumns: "
-                header += "r [au]\t\tI_clean\t\tsigma_clean\t\tI_frank\t\tsigma_frank\t\tI_rave\t\tsigma_lower_rave\t\tsigma_upper_rave"
-            else:
-                profiles = np.array([rf * model["base"]["dist"], Ic_interp, Iec_interp,
-                              If, Ief
-                              ])
-                header += "\nColumns: r [au]\t\tI_clean\t\tsigma_clean\t\tI_frank\t\tsigma_frank"               
-            
-            np.savetxt(ff, profiles.T, header=header)
-
-
-        if profiles_fig:
-            # generate, save figures for brightness profiles of all sources and brightness profiles with uncertainties
+            cols, labs = ['C1', 'C2'], ['clean', 'frank']
+        # legend entries for the profiles, which are drawn as a single collection per panel
+        handles = [Line2D([], [], c=cc, label=ll) for cc, ll in zip(cols, labs)]
+
+        for ii, jj in enumerate(disk_names):
+            rf, Is_interp, Ies_interp, fstar, dist, save_dir = results[ii]
+            r_au = rf * dist
+
+            # profiles and their lower, upper 1 sigma bounds [MJy / sterad], one row per profile
+            I_mjy = np.array(Is_interp) / 1e6
+            Ie_mjy = np.array(Ies_interp) / 1e6
+            I_lo_mjy = I_mjy - Ie_mjy[:, 0]
+            I_hi_mjy = I_mjy + Ie_mjy[:, 1]
+
+            # axis limits set by the profiles (not their uncertainties) and I = 0, 
+            # with the default matplotlib margin in y
+            I_min = min(np.nanmin(I_mjy), 0)
+            I_max = max(np.nanmax(I_mjy), 0)
+            I_pad = 0.05 * (I_max - I_min)
+            xlim = (0, np.nanmax(r_au))
+            ylim = (I_min - I_pad, I_max + I_pad)
+
             for hh in range(2):
-                fig = figs[hh]
-                ax = axs[hh]
-
-                # flatten axes
-                ax = [bb for aa in ax for bb in aa]
-                cols, labs = ['C1', 'C2'], ['clean', 'frank']
-                if include_rave: 
-                    cols, labs = cols.append('C3'), labs.append('rave')                    
-
-                for kk, ll in enumerate(Is_interp):     
-                    # plot profile
-                    ax[ii].plot(rf * model["base"]["dist"], ll / 1e6, c=cols[kk], label=labs[kk])
-                
-                    if hh == 1:
-                        # 1 sigma uncertainty band
-                        band = ax[ii].fill_between(rf * model["base"]["dist"], 
-                                            (ll - Ies_interp[kk][0]) / 1e6, (ll + Ies_interp[kk][1]) / 1e6, 
-                                        color=cols[kk], alpha=0.4)
-                        # prevent 1 sigma band from altering y-limits
-                        band.remove()
-                        ax[ii].relim()
-                        ax[ii].add_collection(band, autolim=False)
+                ax = axs_flat[hh]
+
+                # plot all profiles in one collection
+                segments = [np.column_stack([r_au, ll]) for ll in I_mjy]
+                ax[ii].add_collection(LineCollection(segments, colors=cols))
+
+                if hh == 1:
+                    # 1 sigma uncertainty bands (closed polygons along the lower
+                    # bound and back along the upper bound)
+                    verts = []
+                    for lo, hi in zip(I_lo_mjy, I_hi_mjy):
+                        verts.append(np.concatenate([np.column_stack([r_au, lo]), 
+                                                     np.column_stack([r_au[::-1], hi[::-1]])
+                                                     ]))
+                    ax[ii].add_collection(PolyCollection(verts, facecolors=cols, edgecolors=cols, alpha=0.4), 
+                                          autolim=False)
 
                 ax[ii].axhline(y=0, ls='--', c='k')
+                ax[ii].set_xlim(xlim)
+                ax[ii].set_ylim(ylim)
+                ax[ii].autoscale(enable=False)
 
-                fstar_ujy = model["frank"]["fstar"] * 1e6
+                fstar_ujy = fstar * 1e6
                 ax[ii].set_title(f"{jj}, " + r"$F_* =$ " + f"{fstar_ujy:.0f} uJy", fontsize=10)
 
-                if ii == 0:
-                    ax[ii].legend(loc='upper right', fontsize=8)
-                    ax[ii].set_xlabel('r [au]')
-                    ax[ii].set_ylabel(r'I [MJy sterad$^{-1}$]')
+        # legend and axis labels (on first panel only), added once all sources are plotted
+        for ax in axs_flat:
+            ax[0].legend(handles=handles, loc='upper right', fontsize=8)
+            ax[0].set_xlabel('r [au]')
+            ax[0].set_ylabel(r'I [MJy sterad$^{-1}$]')
 
-    if profiles_fig:
-        print('  Survey summary: making survey summary figure')
-    fig1.suptitle(r'$1\sigma$ uncertainties do not include systematic unc., and are not comparable across models')    
+        fig1.suptitle(r'$1\sigma$ uncertainties do not include systematic unc., and are not comparable across models')    
 
-    ff0 = '{}/survey_profile_summary.png'.format(model["base"]["save_dir"])
-    ff1 = '{}/survey_profile_summary_unc.png'.format(model["base"]["save_dir"])
-    print('    saving figures to {} and {}'.format(ff0, ff1))
+        ff0 = '{}/survey_profile_summary.png'.format(save_dir)
+        ff1 = '{}/survey_profile_summary_unc.png'.format(save_dir)
+        print('    saving figures to {} and {}'.format(ff0, ff1))
 
-    plt.figure(fig0); plt.tight_layout(); plt.savefig(ff0, dpi=300)
-    plt.figure(fig1); plt.tight_layout(); plt.savefig(ff1, dpi=300)
+        # fixed subplot parameters for the 5x4 grid (avoids a layout solve per figure)
+        for fig in figs:
+            fig.subplots_adjust(left=0.08, right=0.98, top=0.92, bottom=0.06, hspace=0.45, wspace=0.3)
 
-    os.remove(gen_pars_current)
+        # single render per figure (no bbox fitting); close figures to release them from pyplot
+        for fig, ff in zip(figs, [ff0, ff1]):
+            fig.savefig(ff, dpi=200, bbox_inches=None)
+            plt.close(fig)
 
     return figs
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # non-interactive backend when run as a script, as figures are then only saved to file
+    import matplotlib
+    matplotlib.use('Agg')
+    main()
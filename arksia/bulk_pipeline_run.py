@@ -2,7 +2,8 @@
 (written by Jeff Jennings)."""
 
 import os
-import json
+
+from arksia.input_output import load_json, save_json
 
 def main(gen_par_f='./pars_gen.json', 
          source_par_f='./pars_source.json',
@@ -21,20 +22,17 @@ def main(gen_par_f='./pars_gen.json',
         Path to the physical parameters file    
     """    
     
-    disk_names = []
-    source_pars = json.load(open(source_par_f, 'r'))
-    for ii in source_pars:
-        disk_names.append(ii)
+    source_pars = load_json(source_par_f)
+    disk_names = list(source_pars)
     
-    gen_pars = json.load(open(gen_par_f, 'r'))
+    gen_pars = load_json(gen_par_f)
     # run the radial pipeline over each source in `disk_names`
     for ii, jj in enumerate(disk_names):
         print(f"\nPipeline call {ii + 1} of {len(disk_names)} - disk {jj}")
 
         gen_pars['base']['input_dir'] = f"./{jj}"
         gen_pars_current = os.path.join(os.path.dirname(gen_par_f), 'pars_gen_temp.json')
-        with open(gen_pars_current, 'w') as f:
-            json.dump(gen_pars, f)
+        save_json(gen_pars, gen_pars_current)
 
         os.system(f"python -m arksia.pipeline -d {jj} -b {gen_pars_current} -s {source_par_f} -p {phys_par_f}")
 
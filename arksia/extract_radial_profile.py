@@ -2,10 +2,9 @@
 (written by Seba Marino and Jeff Jennings)."""
 
 import numpy as np
-from scipy.optimize import fsolve
 from frank.utilities import jy_convert 
 
-def radial_profile_from_image(image, geom, rmax, Nr, phis, 
+def radial_profile_from_image(image, geom, rmax, Nr, phis_rad, 
                             npix, pixel_scale, bmaj, bmin,
                             image_rms, error_std=False, arcsec2=True, 
                             simple_ellipse=False, pb_image=None, 
@@ -23,7 +22,9 @@ def radial_profile_from_image(image, geom, rmax, Nr, phis,
         inc: float, inclination of the disc in degrees
     rmax: float, maximum radius in arcsec
     Nr: int, number of radial bins
-    phis: ndarray, array containing sample of PA's that will be use to calculate average intensity
+    phis_rad: ndarray, array containing sample of PA's [rad] that will be use to calculate average intensity.
+        Can also be a list of such arrays (e.g. for each side of the disc), in which case the image 
+        is sampled once for all of them and a list with a profile for each array is returned
     image_rms: float, image rms in Jy/beam
     error_std: boolean, whether to use the dispersion to calculate uncertainty or the image rms
     arcsec2: boolean, whether to return profile in units of Jy/arcsec2 or Jy/beam
@@ -33,9 +34,6 @@ def radial_profile_from_image(image, geom, rmax, Nr, phis,
     """
     inc, PA, dRA, dDec = geom["inc"], geom["PA"], geom["dRA"], geom["dDec"]
 
-    if pb_image is None:
-        pb_image = np.ones((npix,npix))        
-        
     if model_image:
         if verbose > 0:
             print('      model_image = True --> setting image_rms = 0')
@@ -59,12 +57,12 @@ def radial_profile_from_image(image, geom, rmax, Nr, phis,
             image = image / beam_area
             image_rms = image_rms / beam_area
     
-    return radial_profile(image, pb_image, geom, rmax, Nr, phis, image_rms, 
+    return radial_profile(image, pb_image, geom, rmax, Nr, phis_rad, image_rms, 
                         bmaj, pixel_scale, npix, error_std, arcsec2, 
                         simple_ellipse, model_image)
 
 
-def radial_profile(image, pb_image, geom, rmax, Nr, phis, image_rms, 
+def radial_profile(image, pb_image, geom, rmax, Nr, phis_rad, image_rms, 
                     bmaj, pixel_scale, npix, error_std=False, arcsec2=True, 
                     simple_ellipse=False, model_image=False, rescale_flux=True, 
                     verbose=0):
@@ -74,7 +72,8 @@ def radial_profile(image, pb_image, geom, rmax, Nr, phis, image_rms,
     PA and inc are PA and inc of the disc in deg
     rmax [arcsec] is the maximum deprojected radius at which to do the azimuthal averaging
     Nr is the number of radial points to calculate
-    phis [deg] is an array with uniform spacing that sets the range of PA at which to do the interpolation (0 is north)
+    phis_rad [rad] is an array with uniform spacing that sets the range of PA at which to do the interpolation (0 is north), 
+        or a list of such arrays (returning a list of profiles)
 
     """    
     inc, PA, dRA, dDec = geom["inc"], geom["PA"], geom["dRA"], geom["dDec"] 
@@ -84,88 +83,106 @@ def radial_profile(image, pb_image, geom, rmax, Nr, phis, image_rms,
     if PA < 0: 
         PA = PA + 180
     PA_rad = PA * np.pi / 180
-    phis_rad = phis * np.pi / 180
-    dphi_rad = abs(phis_rad[1] - phis_rad[0])
-    Nphi_rad = len(phis_rad)
+    # all groups of PA's are sampled together, then split back up below
+    phis_list = phis_rad if isinstance(phis_rad, list) else [phis_rad]
+    phis_all = np.concatenate(phis_list)
+    splits = np.cumsum([len(pp) for pp in phis_list])[:-1]
 
     ecc = np.sin(inc * np.pi / 180)
     # aspect ratio between major and minor axis (>=1)
     chi = 1 / (np.sqrt(1 - ecc ** 2))
     
 
-    # calculate radial profile 
-    Is = np.zeros((Nr, Nphi_rad))
-    Is_pb = np.zeros((Nr, Nphi_rad))
-
-    err_count = 0
-    err_count_pb = 0 
-
-    for ii in range(Nr):
-        for jj in range(Nphi_rad):
-            xx, yy = ellipse(dRA, dDec, phis_rad[jj], chi, rs[ii], PA_rad)
-            
-            ip = -int(xx / pixel_scale) + npix // 2
-            jp = int(yy / pixel_scale) + npix // 2
-            try:
-                Is[ii, jj] = image[jp, ip]
-            except IndexError:
-                if err_count == 0:
-                    print('Warning: radial profile extends beyond image. Padding with nan.')
-                err_count += 1
-                Is[ii, jj] = np.nan
-            if not model_image:
-                try:
-                    Is_pb[ii, jj] = pb_image[jp, ip]
-                except IndexError:
-                    if err_count_pb == 0:
-                        print('Warning: radial profile extends beyond PB image. Padding with nan.')
-                    err_count_pb += 1
-                    Is_pb[ii, jj] = np.nan
+    # calculate radial profile: sky positions of all (r, phi) points at once, 
+    # shape (Nr, Nphi)
+    xx, yy = ellipse(dRA, dDec, phis_all[None, :], chi, rs[:, None], PA_rad)
+
+    # nearest pixel to each point (truncating toward zero)
+    ip = -np.trunc(xx / pixel_scale).astype(int) + npix // 2
+    jp = np.trunc(yy / pixel_scale).astype(int) + npix // 2
 
+    Is, inside = sample_image(image, jp, ip)
+    err_count = np.count_nonzero(~inside)
     if err_count > 0:
+        print('Warning: radial profile extends beyond image. Padding with nan.')
         print('  Image padded with {} nan'.format(err_count))
-    if err_count_pb > 0:
-        print('  PB image padded with {} nan'.format(err_count_pb))
 
-    # radial intensity [Jy/arcsec]
-    Ir = np.nanmean(Is, axis=1) 
-    if model_image: 
+    if not model_image:
+        if pb_image is None:
+            # constant primary beam of 1 (no need to sample an image of ones)
+            Is_pb = np.where(inside, 1.0, np.nan)
+        else:
+            Is_pb, inside_pb = sample_image(pb_image, jp, ip)
+            err_count_pb = np.count_nonzero(~inside_pb)
+            if err_count_pb > 0:
+                print('Warning: radial profile extends beyond PB image. Padding with nan.')
+                print('  PB image padded with {} nan'.format(err_count_pb))
+        Is_pb_list = np.split(Is_pb, splits, axis=1)
+    else:
+        Is_pb_list = [None] * len(phis_list)
+
+    profiles = []
+    for phis_rad_i, Is_i, Is_pb_i in zip(np.split(phis_all, splits), 
+                                         np.split(Is, splits, axis=1), 
+                                         Is_pb_list):
+        dphi_rad = abs(phis_rad_i[1] - phis_rad_i[0])
+        Nphi_rad = len(phis_rad_i)
+
+        # radial intensity [Jy/arcsec]
+        Ir = np.nanmean(Is_i, axis=1) 
+        if model_image: 
+            if arcsec2:
+                Ir = jy_convert(Ir, 'arcsec2_sterad')
+            profiles.append((rs, Ir))
+            continue
+
+        # rms noise at each radius, scaled by the primary beam along each azimuth
+        Ir_pb = np.sqrt(np.sum((image_rms / Is_pb_i) ** 2, axis=1) / Nphi_rad)
+
+        # number of independent points 
+        if simple_ellipse:
+            # normalize
+            arclength = (Nphi_rad - 1) * dphi_rad * np.sqrt((1 + (1 / chi) ** 2 ) / 2 ) 
+        else:
+            arclength, _ = arc_length(1, 1 / chi, phis_rad_i[0] - PA_rad, phis_rad_i[-1] - PA_rad)
+
+        if verbose > 0:
+            print('      arc length = {:.2f} deg'.format(arclength * 180 / np.pi))
+        Nindep = rs * arclength / bmaj
+        Nindep[Nindep < 1] = 1
+        
+        if error_std:
+            I_err = np.nanstd(Is_i, axis=1) / np.sqrt(Nindep)
+        else:
+            I_err = Ir_pb / np.sqrt(Nindep)
+
         if arcsec2:
-            Ir = jy_convert(Ir, 'arcsec2_sterad')
-        return rs, Ir
+            Ir = jy_convert(Ir, 'arcsec2_sterad')        
+            I_err = jy_convert(I_err, 'arcsec2_sterad')
 
-    Ir_pb = np.zeros(Nr)
-    
-    for i in range(Nphi_rad):
-        Ir_pb = Ir_pb + (image_rms / Is_pb[:,i]) ** 2
-    Ir_pb = np.sqrt(Ir_pb / Nphi_rad)
-
-    # number of independent points 
-    if simple_ellipse:
-        # normalize
-        arclength = (Nphi_rad - 1) * dphi_rad * np.sqrt((1 + (1 / chi) ** 2 ) / 2 ) 
-    else:
-        arclength, _ = arc_length(1, 1 / chi, phis_rad[0] - PA_rad, phis_rad[-1] - PA_rad)
+        if rescale_flux:
+            Ir = Ir * np.cos(inc * np.pi / 180)
+            I_err = I_err * np.cos(inc * np.pi / 180)
+
+        profiles.append((rs, Ir, I_err))
+
+    if isinstance(phis_rad, list):
+        return profiles
+    return profiles[0]
 
-    if verbose > 0:
-        print('      arc length = {:.2f} deg'.format(arclength * 180 / np.pi))
-    Nindep = rs * arclength / bmaj
-    Nindep[Nindep < 1] = 1
-    
-    if error_std:
-        I_err = np.nanstd(Is, axis=1) / np.sqrt(Nindep)
-    else:
-        I_err = Ir_pb / np.sqrt(Nindep)
 
-    if arcsec2:
-        Ir = jy_convert(Ir, 'arcsec2_sterad')        
-        I_err = jy_convert(I_err, 'arcsec2_sterad')
+def sample_image(image, jp, ip):
+    """
+    Sample an image at integer pixel indices (rows 'jp', columns 'ip'), 
+    with nan for indices that fall outside of the image.
+    Returns the samples and a mask of the points inside the image.
+    """
+    inside = (jp >= 0) & (jp < image.shape[0]) & (ip >= 0) & (ip < image.shape[1])
 
-    if rescale_flux:
-        Ir = Ir * np.cos(inc * np.pi / 180)
-        I_err = I_err * np.cos(inc * np.pi / 180)
+    Is = np.full(jp.shape, np.nan)
+    Is[inside] = image[jp[inside], ip[inside]]
 
-    return rs, Ir, I_err
+    return Is, inside
 
 
 def arc_length(a, b, phi1, phi2, Nint=1000000):
@@ -229,32 +246,27 @@ def ellipse(x0, y0, phi, chi, a, PA):
     # a semi-major axis
     # a/chi semi-minor axis
     # PA  pa of ellipse 0 is north and pi/2 is east
+    # phi and a can be arrays (broadcast against each other)
 
-    if a==0.:
-        return x0*np.ones_like(phi), y0*np.ones_like(phi)
-    
     phipp = phi - PA
-    xpp = x_phi(np.pi / 2 - phipp, a/chi, a)
-    ypp = y_phi(np.pi / 2 - phipp, a/chi, a)
+    # (a=0 points are set to the ellipse center below)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xpp = x_phi(np.pi / 2 - phipp, a/chi, a)
+        ypp = y_phi(np.pi / 2 - phipp, a/chi, a)
 
     xp = xpp * np.cos(PA) + ypp * np.sin(PA)
     yp = -xpp * np.sin(PA) + ypp * np.cos(PA)
     
-    xc = xp + x0
-    yc = yp + y0
+    xc = np.where(a == 0., x0, xp + x0)
+    yc = np.where(a == 0., y0, yp + y0)
     
     return xc, yc
 
 
 def simple_phi(phi): 
-    # returns phi between 0 and 2pi
-    if abs(phi) != 2 * np.pi:
-        phir = phi % (2 * np.pi)
-    else: 
-        phir = phi
-
-    if phir < 0:
-        phir = 2 * np.pi + phir
+    # returns phi between 0 and 2pi (phi can be an array)
+    phir = np.where(np.abs(phi) != 2 * np.pi, np.mod(phi, 2 * np.pi), phi)
+    phir = np.where(phir < 0, 2 * np.pi + phir, phir)
 
     return phir
 
@@ -262,20 +274,14 @@ def simple_phi(phi):
 def x_phi(phi, a, b):
     phi=simple_phi(phi)
     
-    if phi <= np.pi / 2 or phi >= 3 / 2 * np.pi:
-        sign = 1.0
-    else:
-        sign = -1.0
+    sign = np.where((phi <= np.pi / 2) | (phi >= 3 / 2 * np.pi), 1.0, -1.0)
 
     return sign / np.sqrt(np.tan(phi) ** 2 / b ** 2 + 1 / a ** 2)
 
 
 def y_phi(phi, a, b):    
     phi=simple_phi(phi)
-    if phi >= 0 and phi <= np.pi:
-        sign = 1.0
-    else:
-        sign = -1.0
+    sign = np.where((phi >= 0) & (phi <= np.pi), 1.0, -1.0)
     
     return sign / np.sqrt(1 / b ** 2 + 1 / (a ** 2 * np.tan(phi) ** 2))
 
@@ -291,7 +297,7 @@ def Delta_s(xs, a, b):
     else:
         ys[mask]= -b * np.sqrt(1 - xs[mask] ** 2 / a ** 2)
 
-    return np.sqrt((ys[:-1] - ys[1:]) ** 2 + (xs[:-1] - xs[1:]) ** 2)
+    return np.hypot(ys[:-1] - ys[1:], xs[:-1] - xs[1:])
 
 
 # We want to calculate the critical angle phi along an ellipse (from its major axis)
@@ -304,6 +310,10 @@ def Delta_s(xs, a, b):
 # a*cos(inc) (inclined ring). Then the ratio between a and l is 
 
 # a/l(phi)=sqrt(cos(phi)**2+sin(phi)**2/cos(inc)**2)
+
+# Since cos(phi)**2 + sin(phi)**2/cos(inc)**2 = 1 + sin(phi)**2*tan(inc)**2, setting 
+# a/l(phi)=f gives phic in closed form:
+#     sin(phic)=sqrt(f**2-1)/tan(inc)
 def stretching(phi, inc):
     """
     phi and inc in rad
@@ -321,7 +331,5 @@ def find_phic(inc, f):
         print('All phis satisfy condition, using phic=pi/2')
         return np.pi / 2 
               
-    # solve equation stretching-f=0
-    func = lambda phi: stretching(phi, inc) - f
-    phic = fsolve(func, np.pi / 4) # initial guess phic=45deg
-    return phic[0]
+    # solve equation stretching-f=0 (in closed form)
+    return np.arcsin(np.sqrt(f ** 2 - 1) / np.tan(inc))
@@ -2,13 +2,106 @@
 (written by Jeff Jennings)."""
 
 import os
+import copy
+import json
+from functools import lru_cache
 import numpy as np
 
 import astropy.io.fits as pyfits
 
-from frank.utilities import generic_dht, get_fit_stat_uncer
+# optional faster JSON parser/serializer
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# optional faster .fits reader
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+from frank.constants import rad_to_arcsec
+from frank.geometry import FixedGeometry
+from frank.hankel import DiscreteHankelTransform
+from frank.statistical_models import VisibilityMapping
+from frank.utilities import get_fit_stat_uncer
 from frank.io import load_sol, load_uvtable
 
+@lru_cache(maxsize=64)
+def parse_json(path, mtime_ns, size):
+    """
+    Parse a .json file, using `orjson` if it is installed (falling back to the 
+    standard library `json` otherwise, or if `orjson` cannot parse the file, 
+    e.g. because it contains NaN values). Results are cached, keyed on the 
+    file's modification time and size, so an edited file is parsed again
+
+    Parameters
+    ----------
+    path : string
+        Absolute path to the .json file
+    mtime_ns, size : int
+        Modification time [ns] and size [bytes] of the file (from `os.stat`)
+
+    Returns
+    -------
+    contents : dict
+        Contents of the .json file (shared between calls; do not modify)
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+
+    return json.loads(raw)
+
+
+def load_json(path):
+    """
+    Load a .json file, only parsing it again if it has changed since the 
+    last call (see `parse_json`)
+
+    Parameters
+    ----------
+    path : string
+        Path to the .json file
+
+    Returns
+    -------
+    contents : dict
+        Contents of the .json file (a copy that can be freely modified)
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+
+    return copy.deepcopy(parse_json(path, stat.st_mtime_ns, stat.st_size))
+
+
+def save_json(contents, path):
+    """
+    Save a dict to a .json file, using `orjson` if it is installed (falling 
+    back to the standard library `json` otherwise). Note `orjson` saves NaN 
+    values as null
+
+    Parameters
+    ----------
+    contents : dict
+        Contents to save
+    path : string
+        Path to the .json file
+    """
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(contents))
+    else:
+        with open(path, 'w') as f:
+            json.dump(contents, f)
+
+
 def concatenate_vis(in_path, out_path):
     """
     Concatenate the visibilities from multiple files; save as one output .npz file.
@@ -49,6 +142,147 @@ def concatenate_vis(in_path, out_path):
     return [u, v, vis, weights]
 
 
+def save_profile(ff, profile, header='', pars=None):
+    """
+    Save a radial profile, as a .txt file or, if `ff` ends in '.npz', as a 
+    single binary .npz file with entries 'profile' and 'header'
+
+    Parameters
+    ----------
+    ff : string
+        Path to the output .txt or .npz file
+    profile : 2D array
+        Profile to save, one row per radial point
+    header : string, default=''
+        Header describing the profile
+    pars : dict, default=None
+        Parameters used to obtain the profile, saved (as a JSON string) 
+        as the last header line of a .txt file, or as the 'pars' entry 
+        of a .npz file. Retrieve them with `load_profile_pars`
+    """
+    if pars is not None:
+        pars = json.dumps(pars)
+
+    if ff.endswith('.npz'):
+        if pars is None:
+            np.savez(ff, profile=profile, header=header)
+        else:
+            np.savez(ff, profile=profile, header=header, pars=pars)
+    else:
+        if pars is not None:
+            header += '\npars: ' + pars
+        np.savetxt(ff, profile, header=header)
+
+
+def load_profile(ff):
+    """
+    Load a radial profile saved by `save_profile` (in .txt or .npz format, 
+    determined from the extension of `ff`)
+
+    Parameters
+    ----------
+    ff : string
+        Path to the .txt or .npz file
+
+    Returns
+    -------
+    profile : 2D array
+        The profile, one row per radial point
+    """
+    if ff.endswith('.npz'):
+        with np.load(ff) as dat:
+            return dat['profile']
+    return np.genfromtxt(ff)
+
+
+def load_profile_pars(ff):
+    """
+    Load the parameters saved with a radial profile by `save_profile`
+
+    Parameters
+    ----------
+    ff : string
+        Path to the .txt or .npz file
+
+    Returns
+    -------
+    pars : dict or None
+        The parameters used to obtain the profile, or None if the file 
+        does not exist or no parameters were saved with the profile
+    """
+    if not os.path.isfile(ff):
+        return None
+
+    if ff.endswith('.npz'):
+        with np.load(ff) as dat:
+            if 'pars' not in dat.files:
+                return None
+            return json.loads(str(dat['pars']))
+
+    # parameters are on the last header line, before the profile itself
+    with open(ff) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            if line.startswith('# pars: '):
+                return json.loads(line[len('# pars: '):])
+    return None
+
+
+def find_profile(path_stem, profile_format):
+    """
+    Get the path to a radial profile saved by `save_profile`, preferring 
+    `profile_format` but falling back to the other format if only a profile 
+    in that format exists
+
+    Parameters
+    ----------
+    path_stem : string
+        Path to the profile, without the file extension
+    profile_format : {'txt', 'npz'}
+        Preferred format of the profile
+
+    Returns
+    -------
+    ff : string
+        Path to the profile
+    """
+    ff = f"{path_stem}.{profile_format}"
+    other = f"{path_stem}.{'npz' if profile_format == 'txt' else 'txt'}"
+    if not os.path.isfile(ff) and os.path.isfile(other):
+        return other
+    return ff
+
+
+@lru_cache(maxsize=2)
+def load_vis_table(path, mtime_ns, size):
+    """
+    Load a combined visibility .npz file. Results are cached, keyed on the 
+    file's modification time and size, so repeated pipeline runs in the same 
+    process only read the file again if it has changed
+
+    Parameters
+    ----------
+    path : string
+        Absolute path to the .npz file
+    mtime_ns, size : int
+        Modification time [ns] and size [bytes] of the file (from `os.stat`)
+
+    Returns
+    -------
+    uv_data : tuple of array
+        u-coordinates, v-coordinates, visibility amplitudes, weights 
+        (read-only, as they are shared between calls)
+    """
+    with np.load(path) as dat:
+        uv_data = tuple(dat[i] for i in ['u', 'v', 'V', 'weights'])
+
+    for arr in uv_data:
+        arr.flags.writeable = False
+
+    return uv_data
+
+
 def get_vis(model):
     """
     Load (or generate if it does not exist) an ARKS visibility dataset.
@@ -62,16 +296,17 @@ def get_vis(model):
     -------
     uv_data : list
         dataset: u-coordinates, v-coordinates, visibility amplitudes 
-        (Re(V) + Im(V) * 1j), weights
+        (Re(V) + Im(V) * 1j), weights. Arrays loaded from an existing combined 
+        visibility file are read-only (see `load_vis_table`)
     """
 
     combined_vis_path = "{}/vis_combined.npz".format(model["base"]["input_dir"])
 
     if os.path.isfile(combined_vis_path):
         print('    loading combined visibility file {}'.format(combined_vis_path))
-        dat = np.load(combined_vis_path)
-        u, v, vis, weights = [dat[i] for i in ['u', 'v', 'V', 'weights']]
-        uv_data = [u, v, vis, weights] 
+        stat = os.stat(combined_vis_path)
+        uv_data = list(load_vis_table(os.path.abspath(combined_vis_path), 
+                                      stat.st_mtime_ns, stat.st_size))
 
     else:
         print('    combined visibility file {} not found. Creating it by combining .txt files.'.format(combined_vis_path))
@@ -96,7 +331,8 @@ def load_fits_image(fits_image, aux_image=False, verbose=0):
     Parameters
     ----------
     fits_image : string
-        Path to the .fits file
+        Path to the .fits file (read with `fitsio` if it is installed, 
+        otherwise with `astropy`)
     aux_image : bool, default=False
         Whether the .fits image is an 'auxillary' image (such as a dirty image) 
         or a standard clean output image
@@ -110,14 +346,26 @@ def load_fits_image(fits_image, aux_image=False, verbose=0):
         if `aux_image=True`)
     """
 
-    ff = pyfits.open(fits_image)
-    image = get_last2d(ff[0].data) 
+    if not os.path.isfile(fits_image):
+        raise FileNotFoundError(f"No such .fits file: {fits_image}")
+
+    if fitsio is not None:
+        # read only the last 2 dimensions of the primary HDU
+        with fitsio.FITS(fits_image) as ff:
+            header = ff[0].read_header()
+            ndim = len(ff[0].get_dims())
+            slc = [slice(0, 1)] * (ndim - 2) + [slice(None), slice(None)]
+            image = get_last2d(ff[0][tuple(slc)])
+    else:
+        # memory-map the file and copy only the last 2 dimensions
+        with pyfits.open(fits_image, memmap=True) as ff:
+            header = ff[0].header
+            image = np.array(get_last2d(ff[0].data))
 
     if verbose > 0:
-        print('        loading .fits image {}, brightness unit {}'.format(fits_image, ff[0].header['BUNIT']))
+        print('        loading .fits image {}, brightness unit {}'.format(fits_image, header['BUNIT']))
 
     if not aux_image:
-        header = ff[0].header
         bmaj = float(header['BMAJ'])
         bmin = float(header['BMIN'])
         # pixel_scale = float(header['CDELT2']) 
@@ -229,6 +477,109 @@ def load_bestfit_frank_uvtable(model, resid_table=False):
     return [u, v, V, weights]
 
 
+def get_bestfit_paths(model):
+    """
+    Get the paths to the clean, rave and frank best-fit results loaded by 
+    `load_bestfit_profiles`
+
+    Parameters
+    ----------
+    model : dict
+        Dictionary containing pipeline parameters
+
+    Returns
+    -------
+    paths : list of string
+        Paths to the clean and rave brightness profiles and the frank solution
+    """
+    clean_bestfit = find_profile("{}/clean_profile_robust{}".format(
+        model["base"]["clean_dir"], model["clean"]["bestfit"]["robust"]), 
+        model["base"]["profile_format"])
+
+    rave_bestfit = find_profile("{}/rave_profile_robust{}".format(
+        model["base"]["rave_dir"], model["clean"]["bestfit"]["robust"]), 
+        model["base"]["profile_format"])
+
+    # enforce the best-fit has 0 scale height
+    frank_bestfit = "{}/{}_alpha{}_w{}_rout{}_h0.000_fstar{:.0f}uJy_method{}_frank_sol.obj".format(
+                        model["base"]["frank_dir"], 
+                        model["base"]["disk"], 
+                        model["frank"]["bestfit"]["alpha"],
+                        model["frank"]["bestfit"]["wsmooth"],
+                        model["frank"]["bestfit"]["rout"],
+                        model["frank"]["fstar"] * 1e6,
+                        model["frank"]["bestfit"]["method"],
+    )
+
+    return [clean_bestfit, rave_bestfit, frank_bestfit]
+
+
+def is_up_to_date(out_paths, in_paths):
+    """
+    Check whether previously saved outputs can be reused, i.e., whether all 
+    output files exist and are newer than all of the input files they were 
+    produced from
+
+    Parameters
+    ----------
+    out_paths : list of string
+        Paths to the output files
+    in_paths : list of string
+        Paths to the input files
+
+    Returns
+    -------
+    up_to_date : bool
+        True if all of `out_paths` exist and are newer than all of `in_paths`
+    """
+    if not all(os.path.isfile(ff) for ff in out_paths + in_paths):
+        return False
+
+    oldest_out = min(os.path.getmtime(ff) for ff in out_paths)
+    newest_in = max(os.path.getmtime(ff) for ff in in_paths)
+
+    return oldest_out > newest_in
+
+
+def profiles_dht(rs, Is, Rmax, N, grid, inc=0.0):
+    """
+    Compute the visibilities of multiple radial brightness profiles with the 
+    Discrete Hankel Transform. Equivalent to calling 
+    `frank.utilities.generic_dht(r, I, Rmax, N, grid=grid, inc=inc)` for each 
+    profile, but the transform (and its mapping onto 'grid') is constructed once 
+    and applied to all profiles together.
+
+    Parameters
+    ----------
+    rs : list of array, unit = [arcsec]
+        Radial points of each brightness profile
+    Is : list of array, unit = [Jy / sr]
+        Brightness values of each profile
+    Rmax : float, unit = [arcsec]
+        Maximum radius beyond which the brightness is zero
+    N : integer
+        Number of terms to use in the Fourier-Bessel series
+    grid : array, unit = [lambda]
+        Baselines at which to sample the transforms
+    inc : float, unit = [deg], default = 0.0
+        Source inclination (see `frank.utilities.generic_dht`)
+
+    Returns
+    -------
+    Vs : list of array, unit = [Jy]
+        Visibility amplitudes of each profile at 'grid'
+    """
+    DHT = DiscreteHankelTransform(Rmax=Rmax / rad_to_arcsec, N=N, nu=0)
+    geom = FixedGeometry(inc, 0, 0, 0)
+    VM = VisibilityMapping(DHT, geom)
+
+    # map each profile onto the DHT collocation points (one column per profile)
+    y = np.column_stack([np.interp(VM.r, rr, II) for rr, II in zip(rs, Is)])
+    Vs = VM.predict_visibilities(y, grid, geometry=geom)
+
+    return list(Vs.T)
+
+
 def load_bestfit_profiles(model, include_clean=True, include_rave=True):
     """
     Load the clean, rave and frank best-fit radial brightness profiles and 
@@ -256,16 +607,8 @@ def load_bestfit_profiles(model, include_clean=True, include_rave=True):
     """
     clean_results = rave_results = None 
 
-    # enforce the best-fit has 0 scale height
-    frank_bestfit = "{}/{}_alpha{}_w{}_rout{}_h0.000_fstar{:.0f}uJy_method{}_frank_sol.obj".format(
-                        model["base"]["frank_dir"], 
-                        model["base"]["disk"], 
-                        model["frank"]["bestfit"]["alpha"],
-                        model["frank"]["bestfit"]["wsmooth"],
-                        model["frank"]["bestfit"]["rout"],
-                        model["frank"]["fstar"] * 1e6,
-                        model["frank"]["bestfit"]["method"],
-    )
+    clean_bestfit, rave_bestfit, frank_bestfit = get_bestfit_paths(model)
+
     sol = load_sol(frank_bestfit)
     rf, If, Ief = sol.r, sol.I, get_fit_stat_uncer(sol)
 
@@ -276,26 +619,26 @@ def load_bestfit_profiles(model, include_clean=True, include_rave=True):
     
     frank_results = [[rf, If, Ief], [grid, Vf], sol]
 
+    rs, Is = [], []
     if include_clean:
-        clean_bestfit = "{}/clean_profile_robust{}.txt".format(
-            model["base"]["clean_dir"], model["clean"]["bestfit"]["robust"])
-        rc, Ic, Iec = np.genfromtxt(clean_bestfit).T
-    
-        # clean visibility profile
-        _, Vc = generic_dht(rc, Ic, Rmax=sol.Rmax, N=sol._info["N"], grid=grid,
-                                inc=0) # 'inc=0' passed to enforce optically thin assumption
-        
-        clean_results = [[rc, Ic, Iec], [grid, Vc]]
+        rc, Ic, Iec = load_profile(clean_bestfit).T
+        rs.append(rc)
+        Is.append(Ic)
 
     if include_rave:
-        rave_bestfit = "{}/rave_profile_robust{}.txt".format(
-            model["base"]["rave_dir"], model["clean"]["bestfit"]["robust"])
-        rr, Ir, Ier_lo, Ier_hi = np.genfromtxt(rave_bestfit).T
+        rr, Ir, Ier_lo, Ier_hi = load_profile(rave_bestfit).T
+        rs.append(rr)
+        Is.append(Ir)
+
+    if rs:
+        # clean, rave visibility profiles, computed together
+        Vs = profiles_dht(rs, Is, Rmax=sol.Rmax, N=sol._info["N"], grid=grid,
+                          inc=0) # 'inc=0' passed to enforce optically thin assumption
 
-        # rave visibility profile
-        _, Vr = generic_dht(rr, Ir, Rmax=sol.Rmax, N=sol._info["N"], grid=grid,
-                                inc=0)
+    if include_clean:
+        clean_results = [[rc, Ic, Iec], [grid, Vs[0]]]
 
-        rave_results = [[rr, Ir, Ier_lo, Ier_hi], [grid, Vr]]
+    if include_rave:
+        rave_results = [[rr, Ir, Ier_lo, Ier_hi], [grid, Vs[-1]]]
     
     return clean_results, rave_results, frank_results
\ No newline at end of file
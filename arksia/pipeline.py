@@ -1,7 +1,12 @@
 """This module is the main file for running radial pipeline fits and analysis 
 (written by Jeff Jennings)."""
 
-import os; os.environ.get('OMP_NUM_THREADS', '1')
+import os
+# limit OpenMP/BLAS threading (must be set before numpy is imported; 
+# values already set in the environment are kept)
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+os.environ.setdefault('MKL_NUM_THREADS', '1')
+os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
 import json
 import csv
 import argparse
@@ -24,21 +29,21 @@ from arksia import input_output, extract_radial_profile, plot, parametric_fitter
 
 arksia_path = os.path.dirname(arksia.__file__)
 
+# multiplicative factor to convert brightness from [Jy / arcsec^2] to [Jy / sterad]
+arcsec2_to_sterad = jy_convert(1.0, 'arcsec2_sterad')
+
 def get_default_parameter_file():
     """Get the path to the default parameter file"""
     return os.path.join(arksia_path, 'pars_gen.json')
 
 def load_default_parameters():
     """Load the default parameters"""
-    return json.load(open(get_default_parameter_file(), 'r'))
+    return input_output.load_json(get_default_parameter_file())
 
 def get_parameter_descriptions():
     """Get the description for parameters"""
-    with open(os.path.join(arksia_path, 'description_pars_gen.json')) as f:
-        params_gen = json.load(f)
-
-    with open(os.path.join(arksia_path, 'description_pars_source.json')) as f:
-        params_source = json.load(f)
+    params_gen = input_output.load_json(os.path.join(arksia_path, 'description_pars_gen.json'))
+    params_source = input_output.load_json(os.path.join(arksia_path, 'description_pars_source.json'))
     return [params_gen, params_source]
 
 def helper():
@@ -116,7 +121,7 @@ def model_setup(parsed_args):
     """
 
     # generic pipeline parameters
-    model = json.load(open(parsed_args.base_parameter_filename, 'r'))
+    model = input_output.load_json(parsed_args.base_parameter_filename)
     model["base"]["disk"] = parsed_args.disk
 
     print('\nRunning radial profile pipeline for {}'.format(model["base"]["disk"]))
@@ -130,13 +135,14 @@ def model_setup(parsed_args):
         model["base"]["save_dir"] = model["base"]["output_dir"]
     print(f"    Results will be saved in {model['base']['save_dir']}/<frank, clean, rave, parametric>")
 
-    model["base"]["clean_dir"] = os.path.join(model["base"]["save_dir"], "clean")
-    model["base"]["rave_dir"] = os.path.join(model["base"]["save_dir"], "rave")
-    model["base"]["frank_dir"] = os.path.join(model["base"]["save_dir"], "frank")
-    model["base"]["parametric_dir"] = os.path.join(model["base"]["save_dir"], "parametric")
+    for module in ["clean", "rave", "frank", "parametric"]:
+        model["base"][f"{module}_dir"] = os.path.join(model["base"]["save_dir"], module)
+    # output directories needed by the pipeline modules that will be run 
+    # (all created at the end of setup)
+    out_dirs = []
 
     # source-specific pipeline parameters
-    source_pars = json.load(open(parsed_args.source_parameter_filename, 'r'))
+    source_pars = input_output.load_json(parsed_args.source_parameter_filename)
     disk_pars = source_pars[model["base"]["disk"]]
 
     # source-specific physical parameters
@@ -169,18 +175,26 @@ def model_setup(parsed_args):
     else:
         model["base"]["SMG_sub"] = ""
 
+    # (text profiles if not set, as in parameter files predating the option)
+    model["base"].setdefault("profile_format", "txt")
+    supported_formats = ['txt', 'npz']
+    if model["base"]["profile_format"] not in supported_formats:
+        raise ValueError(f"{model['base']['profile_format']} must be one of {supported_formats}")
+
     model["clean"]["npix"] = disk_pars["clean"]["npix"]
     model["clean"]["pixel_scale"] = disk_pars["clean"]["pixel_scale"]
+    # (always extract clean profiles if not set, as in parameter files predating the option)
+    model["clean"].setdefault("force_refresh", True)
 
     if model["base"]["extract_clean_profile"] is True:
-        os.makedirs(model["base"]["clean_dir"], exist_ok=True)
+        out_dirs.append(model["base"]["clean_dir"])
         model["clean"]["image_robust"] = disk_pars["clean"]["image_robust"] 
         model["clean"]["image_rms"] = disk_pars["clean"]["image_rms"]
         robusts, rmss = model["clean"]["image_robust"], model["clean"]["image_rms"]
         model["clean"]["image_rms"] = rmss[robusts.index(model["clean"]["robust"])]
 
     if model["base"]["process_rave_fit"] is True:
-        os.makedirs(model["base"]["rave_dir"], exist_ok=True)
+        out_dirs.append(model["base"]["rave_dir"])
         model["rave"]["pixel_scale"] = disk_pars["rave"]["pixel_scale"]
     
     if True in [model["base"]["run_frank"], model["base"]["reproduce_best_frank"]]:
@@ -205,7 +219,7 @@ def model_setup(parsed_args):
             model["plot"]["frank_resid_im_robust"] = 0.5
 
         else:
-            os.makedirs(model["base"]["frank_dir"], exist_ok=True)
+            out_dirs.append(model["base"]["frank_dir"])
             # handle non-list inputs
             if type(model["frank"]["alpha"]) in [int, float]:
                 model["frank"]["alpha"] = [model["frank"]["alpha"]]
@@ -222,7 +236,7 @@ def model_setup(parsed_args):
                 model["frank"]["max_iter"] = 2000
 
     if model["base"]["run_parametric"] is True:
-        os.makedirs(model["base"]["parametric_dir"], exist_ok=True)
+        out_dirs.append(model["base"]["parametric_dir"])
         # handle non-list input
         if type(model["parametric"]["form"]) is str:
             model["parametric"]["form"] = [model["parametric"]["form"]]
@@ -254,6 +268,9 @@ def model_setup(parsed_args):
     model["clean"]["bestfit"] = disk_pars["clean"]["bestfit"]
     model["frank"]["bestfit"] = disk_pars["frank"]["bestfit"]
 
+    for dd in out_dirs:
+        os.makedirs(dd, exist_ok=True)
+
     return model
 
 
@@ -271,6 +288,13 @@ def extract_clean_profile(model):
         Radial points `r` [arcsec], brightness `I` [Jy/sr] and brightness 
         uncertainty `I_err` [Jy/sr] for each the CLEAN image profile' `r` and 
         `I` for the CLEAN model profile
+
+    Notes
+    -----
+    Unless `model["clean"]["force_refresh"]` is True, previously saved profiles 
+    that are newer than the CLEAN images, and were extracted with the same 
+    source geometry and extraction parameters, are loaded and returned, 
+    without loading the images or extracting the profiles again
     """
     # image filenames 
     base_path = "{}/{}.combined.{}corrected.briggs.{}.{}.{}".format(
@@ -287,6 +311,32 @@ def extract_clean_profile(model):
     pb_fits = base_path + ".pb.fits"
     model_fits = base_path + ".model.fits"
 
+    # radial profile filenames
+    ciff = "{}/clean_profile_robust{}.{}".format(
+        model["base"]["clean_dir"], model["clean"]["robust"], model["base"]["profile_format"])
+    cmff = "{}/clean_model_profile_robust{}.{}".format(
+        model["base"]["clean_dir"], model["clean"]["robust"], model["base"]["profile_format"])    
+
+    # parameters the profiles depend on (saved with the profiles). 
+    # round trip through JSON to compare them with those loaded from a saved profile
+    extract_pars = {"geom": model["base"]["geom"]}
+    for key in ["robust", "rmax", "Nr", "Nphi", "npix", "pixel_scale", "image_rms"]:
+        extract_pars[key] = model["clean"][key]
+    extract_pars = json.loads(json.dumps(extract_pars))
+
+    # reuse saved profiles if they are newer than the images they were extracted from, 
+    # and were extracted with the same parameters
+    in_paths = [clean_fits] + [ff for ff in [pb_fits, model_fits] if os.path.isfile(ff)]
+    out_paths = [ciff] + ([cmff] if os.path.isfile(model_fits) else [])
+    if model["clean"]["force_refresh"] is False and input_output.is_up_to_date(out_paths, in_paths) and \
+        all(input_output.load_profile_pars(ff) == extract_pars for ff in out_paths):
+        print(f"  Clean profiles: reusing saved profiles in {model['base']['clean_dir']} (newer than {clean_fits}, same extraction parameters; set 'force_refresh' to true to extract them again)")
+        r, I, I_err = input_output.load_profile(ciff).T
+        if os.path.isfile(model_fits):
+            r_mod, I_mod = input_output.load_profile(cmff).T
+            return [r, I, I_err], [r_mod, I_mod]
+        return [r, I, I_err], None
+
     clean_image, clean_beam = input_output.load_fits_image(clean_fits)
     bmaj, bmin = clean_beam
     try:
@@ -303,64 +353,57 @@ def extract_clean_profile(model):
     # range in azimuth (PA +- range) over which to average. 
     # f factor removes angles at which resolution is degraded by a factor of >= x in 1.x
     f = 1.3
-    phic_rad = extract_radial_profile.find_phic(model["base"]["geom"]["inc"] * np.pi / 180, f)
+    phic_rad = extract_radial_profile.find_phic(model["base"]["geom"]["inc"] * deg_to_rad, f)
     phic_deg = phic_rad / deg_to_rad
     
 
     print('  Clean profiles: extracting profiles from {} and {} using phi_crit {:.2f} deg'.format(clean_fits, model_fits, phic_deg))
 
-    phis_E = np.linspace(model["base"]["geom"]["PA"] - phic_deg, 
-                        model["base"]["geom"]["PA"] + phic_deg, 
-                        model["clean"]["Nphi"]
-                        ) 
-    
-    phis_W = phis_E + 180
+    PA_rad = model["base"]["geom"]["PA"] * deg_to_rad
+    phis_E = np.linspace(PA_rad - phic_rad, PA_rad + phic_rad, model["clean"]["Nphi"]) 
+    phis_W = phis_E + np.pi
 
-    # radial profile of east and west sides
-    r_E, I_E, I_err_E = extract_radial_profile.radial_profile_from_image(
-        clean_image, geom=model["base"]["geom"], phis=phis_E, bmaj=bmaj, 
-        bmin=bmin, pb_image=pb_image, **model["clean"])
-    r_W, I_W, I_err_W = extract_radial_profile.radial_profile_from_image(
-        clean_image, geom=model["base"]["geom"], phis=phis_W, bmaj=bmaj,
+    # radial profile of east and west sides (sampling the image once for both)
+    (r_E, I_E, I_err_E), (r_W, I_W, I_err_W) = extract_radial_profile.radial_profile_from_image(
+        clean_image, geom=model["base"]["geom"], phis_rad=[phis_E, phis_W], bmaj=bmaj, 
         bmin=bmin, pb_image=pb_image, **model["clean"])
 
-    # average of E and W
-    r, I, I_err = r_W, np.mean((I_E, I_W), axis=0), np.hypot(I_err_E, I_err_W) / 2
+    # average of E and W (without stacking the two sides)
+    r = r_W
+    I = np.add(I_E, I_W)
+    I *= 0.5
+    I_err = np.hypot(I_err_E, I_err_W)
+    I_err *= 0.5
 
     # save radial profile
-    ciff = "{}/clean_profile_robust{}.txt".format(
-        model["base"]["clean_dir"], model["clean"]["robust"])
-    
     print(f"    saving CLEAN image profile to {ciff}")
-    np.savetxt(ciff, 
-        np.array([r, I, I_err]).T, 
+    input_output.save_profile(ciff, 
+        np.column_stack((r, I, I_err)), 
         header='Extracted from {}\nr [arcsec]\tI [Jy/sr]\tI_err [Jy/sr]'.format(
-            clean_fits.split('/')[-1])
+            clean_fits.split('/')[-1]),
+        pars=extract_pars
         )    
 
     if model_image is not None:
         # profile of CLEAN .model image.
         # average across all azimuths (no need to take separate E and W profiles)
-        phis_mod = np.linspace(model["base"]["geom"]["PA"] - 180, 
-                                    model["base"]["geom"]["PA"] + 180,
-                                    model["clean"]["Nphi"] 
-                                    )
+        phis_mod = np.linspace(PA_rad - np.pi, PA_rad + np.pi, model["clean"]["Nphi"])
         
         r_mod, I_mod = extract_radial_profile.radial_profile_from_image(
-            model_image, geom=model["base"]["geom"], phis=phis_mod, bmaj=0, 
+            model_image, geom=model["base"]["geom"], phis_rad=phis_mod, bmaj=0, 
             bmin=0, model_image=True, **model["clean"])
 
-        cmff = "{}/clean_model_profile_robust{}.txt".format(
-            model["base"]["clean_dir"], model["clean"]["robust"])    
-    
         print(f"    saving CLEAN model profile to {cmff}")
-        np.savetxt(cmff,
-            np.array([r_mod, I_mod]).T,        
+        input_output.save_profile(cmff,
+            np.column_stack((r_mod, I_mod)),        
             header='Extracted from {}\nr [arcsec]\tI [Jy/sr]'.format(
-                model_fits.split('/')[-1])
+                model_fits.split('/')[-1]),
+            pars=extract_pars
             )
  
     clean_diag_fig = plot.clean_diag_figure(model, clean_image, [r, I, I_err], model_image, [r_mod, I_mod])
+
+    return [r, I, I_err], [r_mod, I_mod]
     
 
 def process_rave_fit(model):
@@ -385,16 +428,16 @@ def process_rave_fit(model):
     I_err_lo = I - I_err_lo
     I_err_hi = I_err_hi - I
 
-    I = jy_convert(I, 'arcsec2_sterad')
-    I_err_lo = jy_convert(I_err_lo, 'arcsec2_sterad')
-    I_err_hi = jy_convert(I_err_hi, 'arcsec2_sterad')    
+    I *= arcsec2_to_sterad
+    I_err_lo *= arcsec2_to_sterad
+    I_err_hi *= arcsec2_to_sterad
 
-    ff = "{}/rave_profile_robust{}.txt".format(
-        model["base"]["rave_dir"], model["clean"]["robust"])
+    ff = "{}/rave_profile_robust{}.{}".format(
+        model["base"]["rave_dir"], model["clean"]["robust"], model["base"]["profile_format"])
     print('    saving RAVE profile to {}'.format(ff))
 
-    np.savetxt(ff, 
-        np.array([r, I, I_err_lo, I_err_hi]).T, 
+    input_output.save_profile(ff, 
+        np.column_stack((r, I, I_err_lo, I_err_hi)), 
         header='Extracted from {}\nr [arcsec]\tI [Jy/sr]\tI_err (lower bound) [Jy/sr]\tI_err (upper bound) [Jy/sr]'.format(
             fit_path.split('/')[-1])
         )
@@ -449,6 +492,10 @@ def run_frank(model):
             hs = np.logspace(*model["frank"]["scale_height"])
         print("    aspect ratios to be sampled: {}".format(hs))
 
+        # directory for fits with nonzero scale height (created once for all fits)
+        if any(h != 0 for h in hs):
+            os.makedirs(f"{model['base']['frank_dir']}/nonzero_h", exist_ok=True)
+
     # perform frank fit(s)
     def frank_fitter(priors):
         alpha, wsmooth, h = priors 
@@ -494,7 +541,6 @@ def run_frank(model):
             save_dir = model["base"]["frank_dir"]
         else:
             save_dir = f"{model['base']['frank_dir']}/nonzero_h"
-            os.makedirs(save_dir, exist_ok=True)
             
         save_prefix = "{}/{}_alpha{}_w{}_rout{}_h{:.3f}_fstar{:.0f}uJy_method{}".format(
                     save_dir, model["base"]["disk"], 
@@ -556,7 +602,7 @@ def run_frank(model):
         # grids of prior values
         g0, g1, g2 = np.meshgrid(model["frank"]["alpha"], model["frank"]["wsmooth"], hs)
         g0, g1, g2 = g0.flatten(), g1.flatten(), g2.flatten()
-        priors = np.array([g0, g1, g2]).T
+        priors = np.column_stack((g0, g1, g2))
 
         # run fits over grids
         # sols = pool.map(frank_fitter, priors)
@@ -584,7 +630,7 @@ def run_frank(model):
             ff = "{}/vertical_inference_frank.txt".format(model["base"]["save_dir"])
             print("    saving h and log evidence results to {}".format(ff))
             np.savetxt(ff,
-                np.array([g0, g1, g2, logevs]).T, header='alpha\twsmooth\th=H/r\tlog evidence'
+                np.column_stack((g0, g1, g2, logevs)), header='alpha\twsmooth\th=H/r\tlog evidence'
             )
 
         multifit_save_prefix = "{}/{}_fstar{:.0f}uJy_method{}".format(
@@ -739,4 +785,7 @@ def main(*args):
         parametric_fits, fit_region, figs = fit_parametric(fits, model)
 
 if __name__ == "__main__":
+    # non-interactive backend when run as a script, as figures are then only saved to file
+    import matplotlib
+    matplotlib.use('Agg')
     main()
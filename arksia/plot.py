@@ -1,19 +1,66 @@
 """This module contains functions for plotting pipeline results 
 (written by Jeff Jennings)."""
 
+import os
 import numpy as np 
+from functools import lru_cache
 import matplotlib.pyplot as plt 
 from matplotlib.gridspec import GridSpec
 from matplotlib.colors import Normalize
 
-from frank.utilities import UVDataBinner, make_image, sweep_profile, generic_dht, jy_convert
+from frank.utilities import UVDataBinner, make_image, sweep_profile, jy_convert
 from mpol.plot import get_image_cmap_norm
 
-from arksia.input_output import get_vis, load_bestfit_frank_uvtable, load_fits_image, parse_rave_filename
+from arksia.input_output import get_vis, load_bestfit_frank_uvtable, load_fits_image, parse_rave_filename, profiles_dht
 from arksia.extract_radial_profile import radial_profile_from_image
 from arksia.imager import dirty_image
 from arksia.analysis import h_distribution
 
+# multiplicative factor to convert brightness from [Jy / sterad] to [mJy / arcsec^2]
+sterad_to_mjy_arcsec2 = jy_convert(1.0, 'sterad_arcsec2') * 1e3
+
+@lru_cache(maxsize=8)
+def frank_pseudo_image(sol, npix):
+    """
+    Cached `frank.utilities.make_image` (projected), so that figures using the 
+    same frank fit and image size share one image. Returned arrays are read-only, 
+    with the image in float32 (for display).
+    """
+    xf, yf, frank_image = make_image(sol, npix, project=True)
+    frank_image = frank_image.astype(np.float32)
+    for arr in (xf, yf, frank_image):
+        arr.flags.writeable = False
+
+    return xf, yf, frank_image
+
+
+@lru_cache(maxsize=8)
+def load_rave_residual_image(path, mtime_ns, size, pixel_scale):
+    """
+    Cached load of a rave residual image at (absolute) 'path', converted from 
+    [Jy / pixel] to [Jy / arcsec^2] for a pixel width 'pixel_scale' [arcsec]. 
+    Keyed on the file's modification time 'mtime_ns' [ns] and 'size' [bytes] 
+    (from `os.stat`), so the image is only read again if the file has changed. 
+    The returned (float32, for display) array is read-only.
+    """
+    # memory-map the file, so the scaled copy is the only one held in memory
+    raw = np.load(path, mmap_mode='r')
+    rave_resid_im = np.multiply(raw, 1.0 / pixel_scale ** 2, dtype=np.float32)
+    rave_resid_im.flags.writeable = False
+
+    return rave_resid_im
+
+
+def rave_residual_image(path, pixel_scale):
+    """
+    Load a rave residual image at 'path' in [Jy / arcsec^2] for a pixel 
+    width 'pixel_scale' [arcsec] (cached, see `load_rave_residual_image`)
+    """
+    stat = os.stat(path)
+    return load_rave_residual_image(os.path.abspath(path), stat.st_mtime_ns, 
+                                    stat.st_size, pixel_scale)
+
+
 def reset_axis_limits(ax, collection):
     # prevent a plotted quantity 'collection' from altering axis 'ax' limits
     collection.remove()
@@ -152,14 +199,14 @@ def frank_image_diag_figure(model, sol, frank_resid_vis, resid_im_robust=2.0,
     fig, axes = plt.subplots(1, 2, figsize=(10,4))
     
     # make frank pseudo-2d image
-    xf, yf, frank_image = make_image(sol, npix, project=True)
+    xf, yf, frank_image = frank_pseudo_image(sol, npix)
     frank_image = frank_image.T
     frank_image = jy_convert(frank_image, 'sterad_arcsec2')
     frank_extent = [xf[-1], xf[0], yf[-1], yf[0]]
     frank_pixel_scale = np.diff(xf).mean()
 
     # make frank residual image
-    frank_resid_im = dirty_image(frank_resid_vis, robust=resid_im_robust, npix=npix, pixel_scale=frank_pixel_scale)
+    frank_resid_im = dirty_image(frank_resid_vis, robust=resid_im_robust, npix=npix, pixel_scale=frank_pixel_scale).astype(np.float32, copy=False)
     frank_resid_Imax = np.nanmax(abs(frank_resid_im))    
     frank_resid_extent = [xf[-1], xf[0], yf[0], yf[-1]]
 
@@ -236,7 +283,7 @@ def frank_multifit_figure(model, sols, plot_var, single_panel=False, save_prefix
 
         # deproject observed vis
         up, vp, Vp = sols[0].geometry.apply_correction(u, v, vis) # assuming all sols have same geometry
-        bls = np.sqrt(up**2 + vp**2)
+        bls = np.hypot(up, vp)
 
         # bin observed vis
         bin_width = model["plot"]["bin_widths"][-1] # forcing single bin width
@@ -518,7 +565,9 @@ def profile_comparison_figure(fits, model, resid_im_robust=2.0, npix=1000, inclu
 
     cols, marks, labs = ['C1', 'C2'], ['.', '+'], ['clean', 'frank']
     if include_rave is True:
-        cols, marks, labs = cols.append('C3'), marks.append('x'), labs.append('rave')
+        cols.append('C3')
+        marks.append('x')
+        labs.append('rave')
 
     # brightness profiles (clean, frank, rave)
     rs = [rc, rf]
@@ -537,11 +586,11 @@ def profile_comparison_figure(fits, model, resid_im_robust=2.0, npix=1000, inclu
 
     for ii, jj in enumerate(Is_jy_sr):     
         # convert Jy / sterad to mJy / arcsec^2
-        I_mjy_as2 = jy_convert(jj, 'sterad_arcsec2') * 1e3
+        I_mjy_as2 = jj * sterad_to_mjy_arcsec2
         ax0.plot(rs[ii], I_mjy_as2, c=cols[ii], label=labs[ii])
     
-        Ie_lo_mjy_as2 = jy_convert(Ies_jy_sr[ii][0], 'sterad_arcsec2') * 1e3
-        Ie_hi_mjy_as2 = jy_convert(Ies_jy_sr[ii][1], 'sterad_arcsec2') * 1e3
+        Ie_lo_mjy_as2 = Ies_jy_sr[ii][0] * sterad_to_mjy_arcsec2
+        Ie_hi_mjy_as2 = Ies_jy_sr[ii][1] * sterad_to_mjy_arcsec2
         band = ax0.fill_between(rs[ii], I_mjy_as2 - Ie_lo_mjy_as2, I_mjy_as2 + Ie_hi_mjy_as2, 
                          color=cols[ii], alpha=0.4)
         # prevent 1 sigma band from altering y-limits
@@ -552,24 +601,20 @@ def profile_comparison_figure(fits, model, resid_im_robust=2.0, npix=1000, inclu
 
     # deproject vis
     up, vp, Vp = sol.geometry.apply_correction(u, v, vis)
-    bls = np.sqrt(up**2 + vp**2)
+    bls = np.hypot(up, vp)
 
-    phis_mod = np.linspace(model["base"]["geom"]["PA"] - 180, 
-                                  model["base"]["geom"]["PA"] + 180,
-                                  model["clean"]["Nphi"] 
-                                  )
+    PA_rad = model["base"]["geom"]["PA"] * np.pi / 180
+    phis_mod = np.linspace(PA_rad - np.pi, PA_rad + np.pi, model["clean"]["Nphi"])
     
     if include_rave is True:
         # plot 1d rave residual brightness   
         rave_resid_im_path = parse_rave_filename(model, file_type='rave_residual_image')
-        rave_resid_im = np.load(rave_resid_im_path)
-        
-        # convert Jy / pixel to Jy / arcsec
-        rave_resid_im /= model["rave"]["pixel_scale"] ** 2 
+        # (converted from Jy / pixel to Jy / arcsec^2)
+        rave_resid_im = rave_residual_image(rave_resid_im_path, model["rave"]["pixel_scale"])
         
         rave_resid_r, rave_resid_I = radial_profile_from_image( 
             rave_resid_im, geom=model["base"]["geom"], 
-            rmax=max(rr), Nr=len(rr), phis=phis_mod, 
+            rmax=max(rr), Nr=len(rr), phis_rad=phis_mod, 
             npix=rave_resid_im.shape[0], pixel_scale=model["rave"]["pixel_scale"],
             bmaj=0, bmin=0, image_rms=0, model_image=True, arcsec2=False
             )
@@ -579,14 +624,14 @@ def profile_comparison_figure(fits, model, resid_im_robust=2.0, npix=1000, inclu
     # load frank residual visibilities (at projected data u,v)
     frank_resid_vis = load_bestfit_frank_uvtable(model, resid_table=True)
     # get pixel scale
-    xf, _, _ = make_image(sol, npix, project=True)
+    xf, _, _ = frank_pseudo_image(sol, npix)
     frank_pixel_scale = np.diff(xf).mean() / 2
     # plot 1d frank residual brightness
-    frank_resid_im = dirty_image(frank_resid_vis, robust=resid_im_robust, npix=npix, pixel_scale=frank_pixel_scale)
+    frank_resid_im = dirty_image(frank_resid_vis, robust=resid_im_robust, npix=npix, pixel_scale=frank_pixel_scale).astype(np.float32, copy=False)
     
     frank_resid_r, frank_resid_I = radial_profile_from_image(
         frank_resid_im, geom=model["base"]["geom"], 
-        rmax=model["frank"]["rout"], Nr=model["frank"]["N"], phis=phis_mod, 
+        rmax=model["frank"]["rout"], Nr=model["frank"]["N"], phis_rad=phis_mod, 
         npix=model["clean"]["npix"], pixel_scale=model["clean"]["pixel_scale"],
         bmaj=0, bmin=0, image_rms=0, model_image=True, arcsec2=False
         )
@@ -614,12 +659,14 @@ def profile_comparison_figure(fits, model, resid_im_robust=2.0, npix=1000, inclu
 
     # plot binned visibility residuals
     bin_vis = UVDataBinner(bls, Vp, weights, model["plot"]["bin_widths"][-1])    
-    _, bin_Vc = generic_dht(rc, Ic, Rmax=sol.Rmax, N=sol._info["N"], 
-        grid=bin_vis.uv, inc=0)
-    bin_Vf = sol.predict_deprojected(bin_vis.uv, I=If)
+    # clean, rave visibility profiles at the bin centers, computed together
     if include_rave is True:
-        _, bin_Vr = generic_dht(rr, Ir, Rmax=sol.Rmax, N=sol._info["N"], 
+        bin_Vc, bin_Vr = profiles_dht([rc, rr], [Ic, Ir], Rmax=sol.Rmax, N=sol._info["N"], 
+            grid=bin_vis.uv, inc=0)
+    else:
+        [bin_Vc] = profiles_dht([rc], [Ic], Rmax=sol.Rmax, N=sol._info["N"], 
             grid=bin_vis.uv, inc=0)
+    bin_Vf = sol.predict_deprojected(bin_vis.uv, I=If)
 
     resid_yscale_guess = []
     binned_vis_profiles = [bin_Vc, bin_Vf]
@@ -723,11 +770,11 @@ def image_comparison_figure(fits, model, resid_im_robust=2.0, npix=1000, xy_boun
     bmaj, bmin = clean_beam * 3600
     print('    clean beam: bmaj {} x bmin {} arcsec'.format(bmaj, bmin))
     beam_area = np.pi * bmaj * bmin / (4 * np.log(2))
-    clean_image = clean_image / beam_area 
+    clean_image = (clean_image / beam_area).astype(np.float32, copy=False)
 
     # convert clean model image from Jy / pixel to Jy / arcsec^2
     model_image = load_fits_image(model_fits, aux_image=True)    
-    model_image = model_image / model["clean"]["pixel_scale"] ** 2
+    model_image = (model_image / model["clean"]["pixel_scale"] ** 2).astype(np.float32, copy=False)
 
     # set clean image pixel size (assuming square image)
     clean_im_xmax = model["clean"]["pixel_scale"] * model["clean"]["npix"] / 2
@@ -741,18 +788,16 @@ def image_comparison_figure(fits, model, resid_im_robust=2.0, npix=1000, xy_boun
             xmax=rave_im_xmax, ymax=rave_im_xmax, dr=model["rave"]["pixel_scale"], 
             phase_shift=True, geom=sol.geometry
             )
-        rave_image = jy_convert(rave_image, 'sterad_arcsec2')
+        rave_image = jy_convert(rave_image, 'sterad_arcsec2').astype(np.float32, copy=False)
 
         # make rave residual image (again assuming square images)
         rave_resid_im_path = parse_rave_filename(model, file_type='rave_residual_image')
-        rave_resid_im = np.load(rave_resid_im_path)
-
-        # convert Jy / pixel to Jy / arcsec
-        rave_resid_im /= model["rave"]["pixel_scale"] ** 2 
+        # (converted from Jy / pixel to Jy / arcsec^2)
+        rave_resid_im = rave_residual_image(rave_resid_im_path, model["rave"]["pixel_scale"])
         rave_resid_Imax = np.nanmax(abs(rave_resid_im))
 
     # make frank pseudo-2d image
-    xf, yf, frank_image = make_image(sol, npix, project=True)
+    xf, yf, frank_image = frank_pseudo_image(sol, npix)
     frank_image = frank_image.T
     frank_image = jy_convert(frank_image, 'sterad_arcsec2')
     frank_extent = [xf[-1], xf[0], yf[-1], yf[0]]
@@ -760,7 +805,7 @@ def image_comparison_figure(fits, model, resid_im_robust=2.0, npix=1000, xy_boun
 
     frank_resid_vis = load_bestfit_frank_uvtable(model, resid_table=True)
     # generate frank residual image
-    frank_resid_im = dirty_image(frank_resid_vis, robust=resid_im_robust, npix=npix, pixel_scale=frank_pixel_scale)
+    frank_resid_im = dirty_image(frank_resid_vis, robust=resid_im_robust, npix=npix, pixel_scale=frank_pixel_scale).astype(np.float32, copy=False)
     frank_resid_Imax = np.nanmax(abs(frank_resid_im))
     frank_resid_extent = [xf[-1], xf[0], yf[0], yf[-1]]
 
@@ -1,22 +1,27 @@
 """This module runs tests to confirm the code is working correctly."""
 
 import os 
+import csv
 import json
+import tempfile
 import numpy as np 
+import pytest
 
 from arksia import input_output, pipeline, analysis, bulk_pipeline_run, bulk_pipeline_results
 
 tmp_dir = '/tmp/arksia/tests'
 os.makedirs(tmp_dir, exist_ok=True)
 
-def save_custom_gen_pars(gen_pars):
-    """Save an altered generic parameters file"""
+def save_custom_gen_pars(gen_pars, pars_dir):
+    """Save an altered generic parameters file (in `pars_dir`, normally the 
+    test's own `tmp_path`, so the file is removed with it)"""
 
     gen_pars['base']['input_dir'] = 'test/mockAS209'
     gen_pars['base']['output_dir'] = tmp_dir
 
-    gen_pars_file = os.path.join(tmp_dir, 'gen_pars.json')
-    with open(gen_pars_file, 'w') as f:
+    # unique file per call, so repeated calls do not overwrite each other's parameters
+    fd, gen_pars_file = tempfile.mkstemp(prefix='gen_pars_', suffix='.json', dir=pars_dir)
+    with os.fdopen(fd, 'w') as f:
         json.dump(gen_pars, f)
 
     return gen_pars_file
@@ -60,7 +65,7 @@ def test_concat_vis():
     input_output.concatenate_vis(in_path=[f0, f1], out_path=tmp_dir + '/concat_vis_test.npz')
 
 
-def test_pipeline_frank_fit():
+def test_pipeline_frank_fit(tmp_path):
     """Run the pipeline to perform a frank fit (and save fit diagnostics)"""
 
     # Default generic parameters file
@@ -68,12 +73,12 @@ def test_pipeline_frank_fit():
 
     gen_pars = update_frank_pars(gen_pars)
 
-    gen_pars_file = save_custom_gen_pars(gen_pars)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
 
     _run_pipeline(gen_pars_file)
 
 
-def test_pipeline_frank_reproduce_bestfit():
+def test_pipeline_frank_reproduce_bestfit(tmp_path):
     """Run the pipeline to perform a frank fit, using bestfit parameters in 'source_pars'"""
 
     # Default generic parameters file
@@ -81,12 +86,12 @@ def test_pipeline_frank_reproduce_bestfit():
 
     gen_pars = update_frank_pars(gen_pars)
     gen_pars['base']['reproduce_best_frank'] = True
-    gen_pars_file = save_custom_gen_pars(gen_pars)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
 
     _run_pipeline(gen_pars_file)
 
 
-def test_pipeline_frank_logfit():
+def test_pipeline_frank_logfit(tmp_path):
     """Run the pipeline to perform a frank fit in log(brightness)"""
 
     gen_pars = pipeline.load_default_parameters()
@@ -95,12 +100,12 @@ def test_pipeline_frank_logfit():
     
     gen_pars['frank']['method'] = 'LogNormal'
 
-    gen_pars_file = save_custom_gen_pars(gen_pars)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
 
     _run_pipeline(gen_pars_file)
 
 
-def test_pipeline_frank_multifit():
+def test_pipeline_frank_multifit(tmp_path):
     """Run the pipeline to perform multiple frank fits and produce the multi-fit figures"""
 
     gen_pars = pipeline.load_default_parameters()
@@ -110,12 +115,12 @@ def test_pipeline_frank_multifit():
     gen_pars['base']['frank_multifit_fig'] = True
     gen_pars['frank']['alpha'] = [1.5, 1.3]
 
-    gen_pars_file = save_custom_gen_pars(gen_pars)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
 
     _run_pipeline(gen_pars_file)
 
 
-def test_pipeline_frank_vertical_fit():
+def test_pipeline_frank_vertical_fit(tmp_path):
     """Run the pipeline to perform a frank fit with vertical inference"""
 
     gen_pars = pipeline.load_default_parameters()
@@ -124,12 +129,12 @@ def test_pipeline_frank_vertical_fit():
 
     gen_pars['frank']['scale_height'] = 1e-1
 
-    gen_pars_file = save_custom_gen_pars(gen_pars)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
 
     _run_pipeline(gen_pars_file)
 
 
-def test_pipeline_frank_vertical_multifit():
+def test_pipeline_frank_vertical_multifit(tmp_path):
     """Run the pipeline to perform multiple frank fits with vertical inference and produce the aspect ratio figure"""
 
     gen_pars = pipeline.load_default_parameters()
@@ -140,56 +145,81 @@ def test_pipeline_frank_vertical_multifit():
     # multiple values for scale_height will call np.logspace internally
     gen_pars['frank']['scale_height'] = [-2, 0, 3]
 
-    gen_pars_file = save_custom_gen_pars(gen_pars)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
 
     _run_pipeline(gen_pars_file)
 
 
-def test_pipeline_extract_clean_profile():
+def test_pipeline_extract_clean_profile(tmp_path):
     """Run the pipeline to extract a radial brightness profile from a clean image"""
     gen_pars = pipeline.load_default_parameters()
 
     gen_pars['base']['extract_clean_profile'] = True
     gen_pars['clean']['rmax'] = 2.0
+    # (a non-default extraction parameter, reset below)
+    default_Nr = gen_pars['clean']['Nr']
+    gen_pars['clean']['Nr'] = 200
 
-    gen_pars_file = save_custom_gen_pars(gen_pars)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
 
     _run_pipeline(gen_pars_file)
+
+    profile_file = os.path.join(tmp_dir, 'clean', 'clean_profile_robust2.0.txt')
+    assert input_output.load_profile_pars(profile_file)['Nr'] == 200
+
+    # rerun allowing saved profiles to be reused, but with a different 
+    # extraction parameter, which should extract the profiles again
+    gen_pars['clean']['force_refresh'] = False
+    gen_pars['clean']['Nr'] = default_Nr
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
+    mtime = os.path.getmtime(profile_file)
+
+    _run_pipeline(gen_pars_file)
+
+    assert os.path.getmtime(profile_file) != mtime
+    assert input_output.load_profile_pars(profile_file)['Nr'] == default_Nr
+
+    # rerun with the same parameters, reusing the profiles just extracted
+    mtime = os.path.getmtime(profile_file)
+
+    _run_pipeline(gen_pars_file)
+
+    assert os.path.getmtime(profile_file) == mtime
     
 
-def test_pipeline_parametric_fit():
+@pytest.mark.parametrize("form", ['gauss', 'asym_gauss', 'triple_gauss', 'double_powerlaw', 
+                                  'double_powerlaw_erf', 'double_powerlaw_gauss', 'double_powerlaw_double_gauss',
+                                  'single_erf_powerlaw', 'double_erf_powerlaw'])
+def test_pipeline_parametric_fit(form, tmp_path):
     """Run the pipeline to perform a parametric fit of a frank brightness profile
-    over each of the supported parametric forms"""
+    for one of the supported parametric forms"""
     gen_pars = pipeline.load_default_parameters()
 
     gen_pars['base']['run_parametric'] = True
     gen_pars['parametric']['niter'] = 50
+    gen_pars['parametric']['form'] = form
 
-    for pp in ['gauss', 'asym_gauss', 'triple_gauss', 'double_powerlaw', 
-               'double_powerlaw_erf', 'double_powerlaw_gauss', 'double_powerlaw_double_gauss',
-               'single_erf_powerlaw', 'double_erf_powerlaw']:
-        gen_pars['parametric']['form'] = pp
-
-        gen_pars_file = save_custom_gen_pars(gen_pars)
+    # (fit results are saved in `tmp_dir`, alongside the frank fit being fit to)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
 
-        _run_pipeline(gen_pars_file)
+    _run_pipeline(gen_pars_file)
 
 
-def test_pipeline_model_comparison_figs():
+def test_pipeline_model_comparison_figs(tmp_path):
     """Run the pipeline to produce figures comparing clean and frank bestfit models"""
     gen_pars = pipeline.load_default_parameters()
 
     gen_pars['base']['compare_models_fig'] = "clean, frank"
 
-    gen_pars_file = save_custom_gen_pars(gen_pars)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
 
     _run_pipeline(gen_pars_file)
 
 
-def test_bulk_pipeline_run():
+def test_bulk_pipeline_run(tmp_path):
     """Run the pipeline to produce figures comparing clean and frank bestfit models"""
     gen_pars = pipeline.load_default_parameters()
-    gen_pars_file = save_custom_gen_pars(gen_pars)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
     source_pars_file = 'test/mockAS209/mock_pars_source.json'
     phys_pars_file = 'test/mockAS209/mock_pars_phys.csv'
 
@@ -199,10 +229,10 @@ def test_bulk_pipeline_run():
                            )
 
 
-def test_bulk_pipeline_results():
+def test_bulk_pipeline_results(tmp_path):
     """Run the pipeline to produce figures comparing clean and frank bestfit models"""
     gen_pars = pipeline.load_default_parameters()
-    gen_pars_file = save_custom_gen_pars(gen_pars)
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
     source_pars_file = 'test/mockAS209/mock_pars_source.json'
     phys_pars_file = 'test/mockAS209/mock_pars_phys.csv'
 
@@ -212,6 +242,101 @@ def test_bulk_pipeline_results():
                                include_rave=False)
 
 
+def test_bulk_pipeline_results_reuse(tmp_path):
+    """Reuse saved survey radial profiles, unless the parameter files have changed since"""
+    gen_pars = pipeline.load_default_parameters()
+    gen_pars_file = save_custom_gen_pars(gen_pars, tmp_path)
+    source_pars_file = 'test/mockAS209/mock_pars_source.json'
+
+    # copy of the physical parameters file, to be altered below
+    with open('test/mockAS209/mock_pars_phys.csv') as f:
+        phys_pars = list(csv.DictReader(f))
+    phys_pars_file = os.path.join(tmp_path, 'mock_pars_phys.csv')
+
+    def save_phys_pars():
+        with open(phys_pars_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(phys_pars[0]))
+            writer.writeheader()
+            writer.writerows(phys_pars)
+
+    def run():
+        bulk_pipeline_results.main(gen_par_f=gen_pars_file,
+                                   source_par_f=source_pars_file, 
+                                   phys_par_f=phys_pars_file,
+                                   profiles_fig=False,
+                                   include_rave=False)
+
+    save_phys_pars()
+    profiles_file = os.path.join(tmp_dir, 'mockAS209_radial_profiles.txt')
+
+    # profiles saved (as the physical parameters file is newer than any saved profiles)
+    run()
+    mtime = os.path.getmtime(profiles_file)
+    r_au = np.genfromtxt(profiles_file)[:, 0]
+
+    # profiles reused
+    run()
+    assert os.path.getmtime(profiles_file) == mtime
+
+    # profiles recomputed, with the new source distance
+    dist = float(phys_pars[0]['dpc'])
+    phys_pars[0]['dpc'] = str(2 * dist)
+    save_phys_pars()
+
+    run()
+    assert os.path.getmtime(profiles_file) != mtime
+    np.testing.assert_allclose(np.genfromtxt(profiles_file)[:, 0], 2 * r_au)
+
+
+def test_profiles_dht():
+    """Transform multiple brightness profiles at once, matching `generic_dht` for each profile"""
+    from frank.utilities import generic_dht
+
+    r0, r1 = np.linspace(0.01, 2, 300), np.linspace(0, 1.8, 150)
+    I0 = 1e10 * np.exp(-((r0 - 0.8) / 0.2) ** 2)
+    I1 = 5e9 * np.exp(-((r1 - 1.0) / 0.3) ** 2)
+    grid = np.logspace(3, 6, 100)
+
+    Vs = input_output.profiles_dht([r0, r1], [I0, I1], Rmax=2.0, N=100, grid=grid)
+
+    for V, rr, II in zip(Vs, [r0, r1], [I0, I1]):
+        _, V_ref = generic_dht(rr, II, Rmax=2.0, N=100, grid=grid, inc=0)
+        np.testing.assert_allclose(V, V_ref, rtol=1e-10, atol=1e-10 * abs(V_ref).max())
+
+
+def test_save_load_profile(tmp_path):
+    """Save and reload a radial profile (and the parameters used to obtain it) 
+    in each of the supported formats"""
+    rng = np.random.default_rng(42)
+    profile = np.column_stack((np.linspace(0, 2, 50), rng.random(50), rng.random(50)))
+    pars = {'geom': {'inc': 35.0, 'PA': 86.0}, 'rmax': 2.0, 'Nr': 50}
+
+    for fmt in ['txt', 'npz']:
+        ff = os.path.join(tmp_path, f'test_profile.{fmt}')
+        input_output.save_profile(ff, profile, header='r [arcsec]\tI [Jy/sr]\tI_err [Jy/sr]', pars=pars)
+
+        assert input_output.find_profile(os.path.join(tmp_path, 'test_profile'), fmt) == ff
+        np.testing.assert_array_equal(input_output.load_profile(ff), profile)
+        assert input_output.load_profile_pars(ff) == pars
+
+        # no parameters saved
+        input_output.save_profile(ff, profile)
+        assert input_output.load_profile_pars(ff) is None
+
+
+def test_find_phic():
+    """Find the critical azimuth at which an inclined ring's radius is stretched by a factor f"""
+    from arksia.extract_radial_profile import find_phic, stretching
+
+    for inc in [45, 60, 80, 89]:
+        phic = find_phic(inc * np.pi / 180, 1.3)
+        assert 0 < phic < np.pi / 2
+        np.testing.assert_allclose(stretching(phic, inc * np.pi / 180), 1.3, rtol=1e-12)
+
+    # all azimuths satisfy the condition for a nearly face-on ring
+    assert find_phic(10 * np.pi / 180, 1.3) == np.pi / 2
+
+
 def test_analysis_belt_width():
     analysis.resolving_belt_width_figure('test/mockAS209/mock_pars_source.json',
                                          'test',